@@ -1 +1,2 @@
-from .ws import Server, Client, ConnectionError, ConnectionClosed  # noqa: F401
+from .ws import Server, Client, Reactor  # noqa: F401
+from .ws import ConnectionError, ConnectionClosed  # noqa: F401
@@ -1,9 +1,15 @@
+from collections import deque
+import functools
+import os
+import selectors
 import socket
 import ssl
+import struct
 import threading
+import traceback
 from urllib.parse import urlsplit
 
-from wsproto import ConnectionType, WSConnection
+from wsproto import ConnectionState, ConnectionType, WSConnection
 from wsproto.events import (
     AcceptConnection,
     RejectConnection,
@@ -14,9 +20,112 @@ from wsproto.events import (
     TextMessage,
     BytesMessage,
 )
+from wsproto import frame_protocol
 from wsproto.frame_protocol import CloseReason
 from wsproto.utilities import LocalProtocolError
 
+try:  # pragma: no cover
+    from wsaccel.xormask import XorMaskerSimple
+except ImportError:  # pragma: no cover
+    pass
+else:  # pragma: no cover
+    # replace wsproto's pure Python frame masking with the C implementation
+    # from wsaccel, which has the same interface
+    frame_protocol.XorMaskerSimple = XorMaskerSimple
+
+MAX_DRAIN_READS = 16
+STOP = 'stop'
+SENDMSG_THRESHOLD = 4096
+MIN_SOCKET_BUFFER = 1024 * 1024
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):  # pragma: no cover
+    IOV_MAX = -1
+if IOV_MAX <= 0:  # pragma: no cover
+    IOV_MAX = 16  # the smallest limit allowed by POSIX
+
+
+def _binary_frame_header(length):
+    # header of an unmasked, unfragmented binary frame (RFC 6455, 5.2)
+    if length <= 125:
+        return struct.pack('!BB', 0x82, length)
+    elif length <= 0xffff:
+        return struct.pack('!BBH', 0x82, 126, length)
+    return struct.pack('!BBQ', 0x82, 127, length)
+
+
+@functools.lru_cache(maxsize=512)
+def _wsgi_key_to_header(key):
+    # HTTP_SEC_WEBSOCKET_KEY -> b'Sec-Websocket-Key: '
+    return (key[5:].replace('_', '-').title() + ': ').encode('latin-1')
+
+
+@functools.lru_cache(maxsize=None)
+def _autotune_limit(name):
+    # the size up to which Linux grows a socket buffer on its own, which it
+    # stops doing once the size of the buffer is set explicitly
+    try:
+        with open(f'/proc/sys/net/ipv4/{name}') as f:
+            return int(f.read().split()[-1])
+    except (OSError, ValueError, IndexError):  # pragma: no cover
+        return 0
+
+
+def _configure_socket(sock, receive_bytes, connected=False):
+    # send small frames such as pings and pongs right away instead of
+    # waiting for Nagle's algorithm, and detect dead peers
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    except OSError:  # pragma: no cover
+        # not a TCP socket
+        pass
+
+    # make room in the kernel buffers for several reads worth of data, unless
+    # the kernel already grows them that much on its own; the receive window
+    # of a connected socket cannot grow past the window scale negotiated in
+    # the TCP handshake, so its receive buffer is left alone
+    buffer_size = max(receive_bytes * 8, MIN_SOCKET_BUFFER)
+    options = [(socket.SO_SNDBUF, 'tcp_wmem')]
+    if not connected:
+        options.append((socket.SO_RCVBUF, 'tcp_rmem'))
+    for option, sysctl in options:
+        if _autotune_limit(sysctl) >= buffer_size:
+            continue
+        try:
+            if sock.getsockopt(socket.SOL_SOCKET, option) < buffer_size:
+                sock.setsockopt(socket.SOL_SOCKET, option, buffer_size)
+        except OSError:  # pragma: no cover
+            pass
+
+    if hasattr(socket, 'SO_NOSIGPIPE'):  # pragma: no cover
+        # macOS does not have MSG_NOSIGNAL, so writes to a broken connection
+        # are made to fail without a SIGPIPE here instead
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_NOSIGPIPE, 1)
+        except OSError:
+            pass
+
+
+def _connect(host, port, receive_bytes):
+    # try each address of the host in the order given by getaddrinfo(), as
+    # socket.create_connection() does, but configure the socket before it is
+    # connected so that the buffer sizes apply to the TCP handshake
+    error = None
+    for family, socktype, proto, _, address in socket.getaddrinfo(
+            host, port, type=socket.SOCK_STREAM):
+        sock = socket.socket(family, socktype, proto)
+        _configure_socket(sock, receive_bytes)
+        try:
+            sock.connect(address)
+            return sock
+        except OSError as exc:
+            error = exc
+            sock.close()
+    if error is None:  # pragma: no cover
+        error = OSError(f'Cannot resolve {host}')
+    raise error
+
 
 class ConnectionError(RuntimeError):  # pragma: no cover
     """Connection error exception class."""
@@ -30,43 +139,180 @@ class ConnectionClosed(RuntimeError):
     pass
 
 
+class Reactor:
+    """This class services many WebSocket connections from a single thread.
+
+    Connections that are created with a ``reactor`` argument do not start a
+    background thread of their own. Their sockets are watched by the reactor
+    instead, and read from the thread that calls :func:`run` when data
+    arrives. A connection that fails while it is being serviced is closed,
+    without affecting the others.
+
+    Everything the reactor does for a connection blocks all the other
+    connections while it runs. Replies such as pongs and close frames are
+    written with blocking sends, so a peer that does not read its data can
+    stall the reactor. A partial SSL record also blocks the reactor until
+    the rest of the record arrives, so this works best with plain sockets.
+
+    :param selector_class: The selector class to use to watch sockets. The
+                           default is ``selectors.DefaultSelector`` from the
+                           Python standard library.
+    """
+    def __init__(self, selector_class=selectors.DefaultSelector):
+        self.selector = selector_class()
+        self._stopped = False
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ)
+
+    def register(self, sock, callback):
+        """Start watching a socket.
+
+        :param sock: The socket to watch.
+        :param callback: The function to call when the socket is readable.
+        """
+        self.selector.register(sock, selectors.EVENT_READ, callback)
+        self._wakeup()
+
+    def unregister(self, sock):
+        """Stop watching a socket.
+
+        :param sock: The socket to stop watching. Sockets that are not being
+                     watched are ignored.
+        """
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        self._wakeup()
+
+    def run(self):
+        """Service the registered connections until :func:`stop` is called.
+        """
+        while not self._stopped:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    try:
+                        while self._wakeup_recv.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    key.data()
+                except Exception:
+                    # a failing callback must not stop the other connections
+                    self.unregister(key.fileobj)
+                    traceback.print_exc()
+
+    def stop(self):
+        """Stop the reactor.
+
+        If the reactor is not running yet, :func:`run` returns right away
+        when it is called.
+        """
+        self._stopped = True
+        self._wakeup()
+
+    def close(self):
+        """Release the resources used by the reactor."""
+        self.selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+
+    def _wakeup(self):
+        # interrupt a select() call that is in progress in another thread, so
+        # that changes to the watched sockets are seen right away
+        try:
+            self._wakeup_send.send(b'\0')
+        except OSError:  # pragma: no cover
+            pass
+
+
 class Base:
-    def __init__(self, sock=None, connection_type=None, receive_bytes=4096,
-                 thread_class=threading.Thread, event_class=threading.Event):
+    __slots__ = ('sock', 'receive_bytes', '_recv_buf', '_recv_view',
+                 'input_buffer', 'incoming_message', 'event', 'connected',
+                 'is_server', 'ws', '_ws_send', '_sock_sendall',
+                 '_sock_sendmsg', '_can_drain', '_send_flags', 'thread_class',
+                 'thread', 'reactor', '__weakref__')
+
+    def __init__(self, sock=None, connection_type=None, receive_bytes=65536,
+                 thread_class=threading.Thread, event_class=threading.Event,
+                 reactor=None):
         self.sock = sock
         self.receive_bytes = receive_bytes
-        self.input_buffer = []
+        self._recv_buf = bytearray(receive_bytes)
+        self._recv_view = memoryview(self._recv_buf)
+        self.input_buffer = deque()
         self.incoming_message = None
         self.event = event_class()
         self.connected = False
         self.is_server = (connection_type == ConnectionType.SERVER)
 
         self.ws = WSConnection(connection_type)
-        self.handshake()
+        self._ws_send = self.ws.send
+        self._sock_sendall = self.sock.sendall
+        self._sock_sendmsg = None
+        if type(self.sock) is socket.socket and hasattr(self.sock, 'sendmsg'):
+            # only use scatter/gather writes on plain sockets, since SSL and
+            # green sockets do not support them reliably
+            self._sock_sendmsg = self.sock.sendmsg
+        self._can_drain = type(self.sock) is socket.socket and \
+            hasattr(socket, 'MSG_DONTWAIT')
+        self._send_flags = 0
+        if type(self.sock) is socket.socket:
+            # report a broken connection as an error instead of a SIGPIPE on
+            # every write (SSL sockets do not accept flags)
+            self._send_flags = getattr(socket, 'MSG_NOSIGNAL', 0)
+        self.thread_class = thread_class
+        self.thread = None
+        self.reactor = reactor
 
+    def _finish_init(self):
+        # subclasses call this once their handshake is complete
         if not self.connected:  # pragma: no cover
             raise ConnectionError()
-        self.thread = thread_class(target=self._thread)
-        self.thread.start()
-
-    def handshake(self):  # pragma: no cover
-        # to be implemented by subclasses
-        pass
+        if self.reactor is not None:
+            self.reactor.register(self.sock, self._on_readable)
+        else:
+            self.thread = self.thread_class(target=self._thread)
+            self.thread.start()
 
     def send(self, data):
         """Send data over the WebSocket connection.
 
-        :param data: The data to send. If ``data`` is of type ``bytes``, then
-                     a binary message is sent. Else, the message is sent in
-                     text format.
+        :param data: The data to send. If ``data`` is of type ``str``, then
+                     a text message is sent. If it is of type ``bytes``,
+                     ``bytearray`` or ``memoryview``, then a binary message
+                     is sent. Any other type raises ``TypeError``. The
+                     data is fully written when this method returns, so a
+                     ``bytearray`` or ``memoryview`` buffer can be reused
+                     for the next message.
         """
         if not self.connected:
             raise ConnectionClosed()
-        if isinstance(data, bytes):
-            out_data = self.ws.send(Message(data=data))
+        if isinstance(data, str):
+            out_data = self._ws_send(TextMessage(data=data))
+        elif isinstance(data, (bytes, bytearray, memoryview)):
+            if isinstance(data, memoryview):
+                # work with a flat view of the bytes, which only requires a
+                # copy when the buffer is not contiguous
+                data = data.cast('B') if data.c_contiguous else data.tobytes()
+            if self.is_server and self._sock_sendmsg is not None and \
+                    len(data) > SENDMSG_THRESHOLD and \
+                    self.ws.state is ConnectionState.OPEN:
+                # server frames are not masked and no extensions are ever
+                # negotiated, so the payload can be sent as is after the
+                # header, without wsproto making a copy of it
+                self._send_chunks([_binary_frame_header(len(data)), data])
+                return
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            out_data = self._ws_send(Message(data=data))
         else:
-            out_data = self.ws.send(TextMessage(data=str(data)))
-        self.sock.send(out_data)
+            raise TypeError(f'Cannot send data of type {type(data).__name__}')
+        self._sock_sendall(out_data, self._send_flags)
 
     def receive(self, timeout=None):
         """Receive data over the WebSocket connection.
@@ -84,7 +330,7 @@ class Base:
             self.event.clear()
         if not self.connected:  # pragma: no cover
             raise ConnectionClosed()
-        return self.input_buffer.pop(0)
+        return self.input_buffer.popleft()
 
     def close(self, reason=None, message=None):
         """Close the WebSocket connection.
@@ -96,61 +342,156 @@ class Base:
         """
         if not self.connected:
             raise ConnectionClosed()
-        out_data = self.ws.send(CloseConnection(
+        out_data = self._ws_send(CloseConnection(
             reason or CloseReason.NORMAL_CLOSURE, message))
         try:
-            self.sock.send(out_data)
-        except BrokenPipeError:  # pragma: no cover
+            self._sock_sendall(out_data, self._send_flags)
+        except OSError:
+            # the other side already went away
             pass
         self.connected = False
+        if self.reactor is not None:
+            self.reactor.unregister(self.sock)
 
     def _thread(self):
         while self.connected:
-            try:
-                in_data = self.sock.recv(self.receive_bytes)
-                if len(in_data) == 0:
-                    raise OSError()
-            except (OSError, ConnectionResetError):  # pragma: no cover
-                self.connected = False
-                self.event.set()
+            if not self._read():
                 break
-            self.ws.receive_data(in_data)
+
+    def _on_readable(self):
+        # called by the reactor when the socket has data to read; SSL sockets
+        # may have decrypted data left over that the selector will not report
+        try:
+            connected = self._read()
+            if isinstance(self.sock, ssl.SSLSocket):
+                while connected and self.sock.pending():
+                    connected = self._read()
+        except Exception:
+            # close this connection, and let the reactor report the error
+            self.reactor.unregister(self.sock)
+            self.connected = False
+            self.event.set()
+            raise
+        if not connected:
+            self.reactor.unregister(self.sock)
+
+    def _read(self):
+        try:
+            n = self.sock.recv_into(self._recv_buf)
+            if n == 0:
+                raise OSError()
+            in_data = bytes(self._recv_view[:n])
+        except (OSError, ConnectionResetError):  # pragma: no cover
+            self.connected = False
+            self.event.set()
+            return False
+        self.ws.receive_data(in_data)
+        if self._can_drain and n == len(self._recv_buf):
+            self._drain()
+        try:
             self.connected = self._handle_events()
+        except OSError:
+            # the replies to the events handled could not be sent
+            self.connected = False
+            self.event.set()
+        return self.connected
+
+    def _drain(self):
+        # feed any data that is already queued in the kernel to wsproto
+        # without blocking, so that it is all handled in a single pass
+        for _ in range(MAX_DRAIN_READS):
+            try:
+                n = self.sock.recv_into(self._recv_buf, 0,
+                                        socket.MSG_DONTWAIT)
+            except OSError:
+                # nothing left to read, or an error that the next blocking
+                # read will report
+                break
+            if n == 0:
+                break
+            self.ws.receive_data(bytes(self._recv_view[:n]))
+            if n < len(self._recv_buf):
+                break
 
     def _handle_events(self):
         keep_going = True
-        out_data = b''
+        notify = False
+        chunks = []
+        handlers = self._event_handlers
         for event in self.ws.events():
+            handler = handlers.get(type(event))
+            if handler is None:  # pragma: no cover
+                continue
             try:
-                if isinstance(event, Request):
-                    out_data += self.ws.send(AcceptConnection())
-                elif isinstance(event, CloseConnection):
-                    if self.is_server:
-                        out_data += self.ws.send(event.response())
-                    self.event.set()
-                    keep_going = False
-                elif isinstance(event, Ping):
-                    out_data += self.ws.send(event.response())
-                elif isinstance(event, (TextMessage, BytesMessage)):
-                    if self.incoming_message is None:
-                        self.incoming_message = event.data
-                    else:
-                        self.incoming_message += event.data
-                    if not event.message_finished:
-                        continue
-                    self.input_buffer.append(self.incoming_message)
-                    self.incoming_message = None
-                    self.event.set()
-                else:  # pragma: no cover
-                    pass
+                result = handler(self, event, chunks)
             except LocalProtocolError:  # pragma: no cover
-                out_data = b''
-                self.event.set()
+                chunks = []
+                notify = True
                 keep_going = False
-        if out_data:
-            self.sock.send(out_data)
+                continue
+            if result:
+                notify = True
+                if result is STOP:
+                    keep_going = False
+        if chunks:
+            self._send_chunks(chunks)
+        if notify:
+            # wake up the receiver once for the whole batch of events, after
+            # the connection state has been updated
+            if not keep_going:
+                self.connected = False
+            self.event.set()
         return keep_going
 
+    # event handlers return True when the receiver needs to be woken up, or
+    # STOP when it also needs to be told that the connection is closed
+
+    def _on_request(self, event, chunks):
+        chunks.append(self._ws_send(AcceptConnection()))
+
+    def _on_close(self, event, chunks):
+        if self.is_server:
+            chunks.append(self._ws_send(event.response()))
+        return STOP
+
+    def _on_ping(self, event, chunks):
+        chunks.append(self._ws_send(event.response()))
+
+    def _on_message(self, event, chunks):
+        if self.incoming_message is None:
+            self.incoming_message = event.data
+        else:
+            self.incoming_message += event.data
+        if not event.message_finished:
+            return False
+        self.input_buffer.append(self.incoming_message)
+        self.incoming_message = None
+        return True
+
+    _event_handlers = {
+        Request: _on_request,
+        CloseConnection: _on_close,
+        Ping: _on_ping,
+        TextMessage: _on_message,
+        BytesMessage: _on_message,
+    }
+
+    def _send_chunks(self, chunks):
+        if len(chunks) == 1 or self._sock_sendmsg is None:
+            self._sock_sendall(b''.join(chunks), self._send_flags)
+            return
+        # gather the chunks in as few system calls as the kernel's limit on
+        # buffers per call allows, then send whatever it did not accept
+        for i in range(0, len(chunks), IOV_MAX):
+            batch = chunks[i:i + IOV_MAX]
+            sent = self._sock_sendmsg(batch, (), self._send_flags)
+            for chunk in batch:
+                if sent >= len(chunk):
+                    sent -= len(chunk)
+                    continue
+                self._sock_sendall(memoryview(chunk)[sent:], self._send_flags)
+                sent = 0
+
 
 class Server(Base):
     """This class implements a WebSocket server.
@@ -164,16 +505,22 @@ class Server(Base):
                     Eventlet and Gevent are the only web servers that are
                     currently supported.
     :param receive_bytes: The size of the receive buffer, in bytes. The
-                          default is 4096.
+                          default is 65536.
     :param thread_class: The ``Thread`` class to use when creating background
                          threads. The default is the ``threading.Thread``
                          class from the Python standard library.
     :param event_class: The ``Event`` class to use when creating event
                         objects. The default is the `threading.Event`` class
                         from the Python standard library.
+    :param reactor: A :class:`Reactor` instance that will read from this
+                    connection. The default is ``None``, which starts a
+                    background thread for the connection instead.
     """
-    def __init__(self, environ, receive_bytes=4096,
-                 thread_class=threading.Thread, event_class=threading.Event):
+    __slots__ = ('environ',)
+
+    def __init__(self, environ, receive_bytes=65536,
+                 thread_class=threading.Thread, event_class=threading.Event,
+                 reactor=None):
         self.environ = environ
         sock = None
         if 'werkzeug.socket' in environ:
@@ -195,19 +542,24 @@ class Server(Base):
                 sock = wsgi_input.raw._sock
         if sock is None:
             raise RuntimeError('Cannot obtain socket from WSGI environment.')
+        if hasattr(sock, 'setsockopt'):
+            _configure_socket(sock, receive_bytes, connected=True)
         super().__init__(sock, connection_type=ConnectionType.SERVER,
                          receive_bytes=receive_bytes,
-                         thread_class=thread_class, event_class=event_class)
+                         thread_class=thread_class, event_class=event_class,
+                         reactor=reactor)
 
-    def handshake(self):
-        in_data = b'GET / HTTP/1.1\r\n'
+        # feed the WSGI request to wsproto to complete the server handshake
+        # (WSGI strings are latin-1 as per PEP 3333)
+        parts = [b'GET / HTTP/1.1\r\n']
         for key, value in self.environ.items():
             if key.startswith('HTTP_'):
-                header = '-'.join([p.capitalize() for p in key[5:].split('_')])
-                in_data += f'{header}: {value}\r\n'.encode()
-        in_data += b'\r\n'
-        self.ws.receive_data(in_data)
+                parts.append(_wsgi_key_to_header(key))
+                parts.append(f'{value}\r\n'.encode('latin-1'))
+        parts.append(b'\r\n')
+        self.ws.receive_data(b''.join(parts))
         self.connected = self._handle_events()
+        self._finish_init()
 
 
 class Client(Base):
@@ -216,7 +568,7 @@ class Client(Base):
     :param url: The connection URL. Both ``ws://`` and ``wss://`` URLs are
                 accepted.
     :param receive_bytes: The size of the receive buffer, in bytes. The
-                          default is 4096.
+                          default is 65536.
     :param thread_class: The ``Thread`` class to use when creating background
                          threads. The default is the ``threading.Thread``
                          class from the Python standard library.
@@ -225,9 +577,15 @@ class Client(Base):
                         from the Python standard library.
     :param ssl_context: An ``SSLContext`` instance, if a default SSL context
                         isn't sufficient.
+    :param reactor: A :class:`Reactor` instance that will read from this
+                    connection. The default is ``None``, which starts a
+                    background thread for the connection instead.
     """
-    def __init__(self, url, receive_bytes=4096, thread_class=threading.Thread,
-                 event_class=threading.Event, ssl_context=None):
+    __slots__ = ('host', 'port', 'path')
+    _default_ssl_context = None
+
+    def __init__(self, url, receive_bytes=65536, thread_class=threading.Thread,
+                 event_class=threading.Event, ssl_context=None, reactor=None):
         parsed_url = urlsplit(url)
         is_secure = parsed_url.scheme in ['https', 'wss']
         self.host = parsed_url.hostname
@@ -236,30 +594,50 @@ class Client(Base):
         if parsed_url.query:
             self.path += '?' + parsed_url.query
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = _connect(self.host, self.port, receive_bytes)
         if is_secure:
             if ssl_context is None:
-                ssl_context = ssl.create_default_context(
-                    purpose=ssl.Purpose.SERVER_AUTH)
+                ssl_context = self._get_default_ssl_context()
             sock = ssl_context.wrap_socket(sock, server_hostname=self.host)
-        sock.connect((self.host, self.port))
         super().__init__(sock, connection_type=ConnectionType.CLIENT,
                          receive_bytes=receive_bytes,
-                         thread_class=thread_class, event_class=event_class)
+                         thread_class=thread_class, event_class=event_class,
+                         reactor=reactor)
 
-    def handshake(self):
-        out_data = self.ws.send(Request(host=self.host, target=self.path))
-        self.sock.send(out_data)
+        # send the upgrade request and wait for the server to accept it
+        out_data = self._ws_send(Request(host=self.host, target=self.path))
+        self._sock_sendall(out_data, self._send_flags)
 
-        in_data = self.sock.recv(self.receive_bytes)
-        self.ws.receive_data(in_data)
-        event = next(self.ws.events())
+        event = None
+        while event is None:
+            in_data = self.sock.recv(self.receive_bytes)
+            if len(in_data) == 0:  # pragma: no cover
+                raise ConnectionError()
+            self.ws.receive_data(in_data)
+            event = next(self.ws.events(), None)
         if isinstance(event, RejectConnection):  # pragma: no cover
             raise ConnectionError(event.status_code)
         elif not isinstance(event, AcceptConnection):  # pragma: no cover
             raise ConnectionError(400)
         self.connected = True
 
+        # handle any frames that arrived together with the handshake
+        # response now, instead of waiting for more data to be received
+        if self._handle_events():
+            self._finish_init()
+
+    @staticmethod
+    def _get_default_ssl_context():
+        # loading the system CA certificates is slow, so the default context
+        # is created once and shared by all clients
+        if Client._default_ssl_context is None:
+            ssl_context = ssl.create_default_context(
+                purpose=ssl.Purpose.SERVER_AUTH)
+            if ssl.HAS_ALPN:
+                ssl_context.set_alpn_protocols(['http/1.1'])
+            Client._default_ssl_context = ssl_context
+        return Client._default_ssl_context
+
     def close(self, reason=None, message=None):
         super().close(reason=reason, message=message)
         self.sock.close()
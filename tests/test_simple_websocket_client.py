@@ -1,3 +1,4 @@
+import socket
 import time
 import unittest
 from unittest import mock
@@ -14,29 +15,89 @@ class SimpleWebSocketClientTestCase(unittest.TestCase):
             [iter(ev) for ev in
              [[AcceptConnection()]] + events + [[CloseConnection(1000)]]]
         mock_wsconn().send = lambda x: str(x).encode('utf-8')
-        return simple_websocket.Client(url)
+        simple_websocket.ws.socket.socket().getsockopt.return_value = 65536
+        with mock.patch('simple_websocket.ws.socket.getaddrinfo') as gai:
+            gai.return_value = [
+                (socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::1', 80)),
+                (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('1.2.3.4', 80)),
+            ]
+            return simple_websocket.Client(url)
 
+    @mock.patch('simple_websocket.ws._autotune_limit', lambda name: 0)
     @mock.patch('simple_websocket.ws.socket.socket')
     @mock.patch('simple_websocket.ws.WSConnection')
     def test_make_client(self, mock_wsconn, mock_socket):
         mock_socket.return_value.recv.return_value = b'x'
+        mock_socket.return_value.recv_into.return_value = 1
         client = self.get_client(mock_wsconn, 'ws://example.com/ws?a=1')
         assert client.sock == mock_socket()
-        assert client.receive_bytes == 4096
-        assert client.input_buffer == []
+        mock_socket.assert_any_call(socket.AF_INET6, socket.SOCK_STREAM, 6)
+        client.sock.connect.assert_called_once_with(('::1', 80))
+        client.sock.setsockopt.assert_any_call(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client.sock.setsockopt.assert_any_call(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        client.sock.setsockopt.assert_any_call(
+            socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024)
+        assert client.receive_bytes == 65536
+        assert len(client.input_buffer) == 0
         assert client.event.__class__.__name__ == 'Event'
-        client.sock.send.assert_called_with(
+        client.sock.sendall.assert_called_with(
             b"Request(host='example.com', target='/ws?a=1', extensions=[], "
-            b"extra_headers=[], subprotocols=[])")
+            b"extra_headers=[], subprotocols=[])", 0)
         assert not client.is_server
         assert client.host == 'example.com'
         assert client.port == 80
         assert client.path == '/ws?a=1'
 
+    @mock.patch('simple_websocket.ws.socket.socket')
+    @mock.patch('simple_websocket.ws.WSConnection')
+    def test_make_client_fallback(self, mock_wsconn, mock_socket):
+        mock_socket.return_value.recv.return_value = b'x'
+        mock_socket.return_value.recv_into.return_value = 1
+        mock_socket.return_value.connect.side_effect = [OSError(), None]
+        client = self.get_client(mock_wsconn, 'ws://example.com/ws')
+        client.sock.connect.assert_has_calls([
+            mock.call(('::1', 80)), mock.call(('1.2.3.4', 80))])
+        mock_socket.assert_called_with(socket.AF_INET, socket.SOCK_STREAM, 6)
+        client.sock.close.assert_called_once_with()
+
+    @mock.patch('simple_websocket.ws.Client._default_ssl_context', None)
+    @mock.patch('simple_websocket.ws.ssl.create_default_context')
+    @mock.patch('simple_websocket.ws.socket.socket')
+    @mock.patch('simple_websocket.ws.WSConnection')
+    def test_make_secure_client(self, mock_wsconn, mock_socket, mock_ssl):
+        ssl_context = mock_ssl.return_value
+        ssl_context.wrap_socket.return_value = mock_socket()
+        mock_socket.return_value.recv.return_value = b'x'
+        mock_socket.return_value.recv_into.return_value = 1
+        client = self.get_client(mock_wsconn, 'wss://example.com/ws')
+        assert client.port == 443
+        ssl_context.wrap_socket.assert_called_with(
+            mock_socket(), server_hostname='example.com')
+        ssl_context.set_alpn_protocols.assert_called_once_with(['http/1.1'])
+        self.get_client(mock_wsconn, 'wss://example.com/ws')
+        assert mock_ssl.call_count == 1
+
+    @mock.patch('simple_websocket.ws.Client._default_ssl_context', None)
+    @mock.patch('simple_websocket.ws.ssl.HAS_ALPN', False)
+    @mock.patch('simple_websocket.ws.ssl.create_default_context')
+    @mock.patch('simple_websocket.ws.socket.socket')
+    @mock.patch('simple_websocket.ws.WSConnection')
+    def test_make_secure_client_no_alpn(self, mock_wsconn, mock_socket,
+                                        mock_ssl):
+        ssl_context = mock_ssl.return_value
+        ssl_context.wrap_socket.return_value = mock_socket()
+        mock_socket.return_value.recv.return_value = b'x'
+        mock_socket.return_value.recv_into.return_value = 1
+        self.get_client(mock_wsconn, 'wss://example.com/ws')
+        ssl_context.set_alpn_protocols.assert_not_called()
+
     @mock.patch('simple_websocket.ws.socket.socket')
     @mock.patch('simple_websocket.ws.WSConnection')
     def test_send(self, mock_wsconn, mock_socket):
         mock_socket.return_value.recv.return_value = b'x'
+        mock_socket.return_value.recv_into.return_value = 1
         client = self.get_client(mock_wsconn, 'ws://example.com/ws')
         while client.connected:
             time.sleep(0.01)
@@ -44,18 +105,29 @@ class SimpleWebSocketClientTestCase(unittest.TestCase):
             client.send('hello')
         client.connected = True
         client.send('hello')
-        mock_socket().send.assert_called_with(
+        mock_socket().sendall.assert_called_with(
             b"TextMessage(data='hello', frame_finished=True, "
-            b"message_finished=True)")
+            b"message_finished=True)", 0)
         client.send(b'hello')
-        mock_socket().send.assert_called_with(
+        mock_socket().sendall.assert_called_with(
+            b"Message(data=b'hello', frame_finished=True, "
+            b"message_finished=True)", 0)
+        client.send(bytearray(b'hello'))
+        mock_socket().sendall.assert_called_with(
+            b"Message(data=bytearray(b'hello'), frame_finished=True, "
+            b"message_finished=True)", 0)
+        client.send(memoryview(b'hello'))
+        mock_socket().sendall.assert_called_with(
             b"Message(data=b'hello', frame_finished=True, "
-            b"message_finished=True)")
+            b"message_finished=True)", 0)
+        with pytest.raises(TypeError):
+            client.send(123)
 
     @mock.patch('simple_websocket.ws.socket.socket')
     @mock.patch('simple_websocket.ws.WSConnection')
     def test_receive(self, mock_wsconn, mock_socket):
         mock_socket.return_value.recv.return_value = b'x'
+        mock_socket.return_value.recv_into.return_value = 1
         client = self.get_client(mock_wsconn, 'ws://example.com/ws', events=[
             [TextMessage('hello')],
             [BytesMessage(b'hello')],
@@ -67,21 +139,37 @@ class SimpleWebSocketClientTestCase(unittest.TestCase):
         assert client.receive() == b'hello'
         assert client.receive(timeout=0) is None
 
+    @mock.patch('simple_websocket.ws.socket.socket')
+    @mock.patch('simple_websocket.ws.WSConnection')
+    def test_receive_with_handshake(self, mock_wsconn, mock_socket):
+        mock_socket.return_value.recv.return_value = b'x'
+        mock_socket.return_value.recv_into.side_effect = [0]
+        client = self.get_client(mock_wsconn, 'ws://example.com/ws', events=[
+            [TextMessage('hello')],
+        ])
+        while client.connected:
+            time.sleep(0.01)
+        client.connected = True
+        assert client.receive() == 'hello'
+        assert client.receive(timeout=0) is None
+
     @mock.patch('simple_websocket.ws.socket.socket')
     @mock.patch('simple_websocket.ws.WSConnection')
     def test_receive_ping(self, mock_wsconn, mock_socket):
         mock_socket.return_value.recv.return_value = b'x'
+        mock_socket.return_value.recv_into.return_value = 1
         client = self.get_client(mock_wsconn, 'ws://example.com/ws', events=[
             [Ping(b'hello')],
         ])
         while client.connected:
             time.sleep(0.01)
-        mock_socket().send.assert_any_call(b"Pong(payload=b'hello')")
+        mock_socket().sendall.assert_any_call(b"Pong(payload=b'hello')", 0)
 
     @mock.patch('simple_websocket.ws.socket.socket')
     @mock.patch('simple_websocket.ws.WSConnection')
     def test_receive_empty(self, mock_wsconn, mock_socket):
-        mock_socket.return_value.recv.side_effect = [b'x', b'x', b'']
+        mock_socket.return_value.recv.return_value = b'x'
+        mock_socket.return_value.recv_into.side_effect = [1, 0]
         client = self.get_client(mock_wsconn, 'ws://example.com/ws', events=[
             [TextMessage('hello')],
         ])
@@ -95,6 +183,7 @@ class SimpleWebSocketClientTestCase(unittest.TestCase):
     @mock.patch('simple_websocket.ws.WSConnection')
     def test_close(self, mock_wsconn, mock_socket):
         mock_socket.return_value.recv.return_value = b'x'
+        mock_socket.return_value.recv_into.return_value = 1
         client = self.get_client(mock_wsconn, 'ws://example.com/ws')
         while client.connected:
             time.sleep(0.01)
@@ -103,6 +192,6 @@ class SimpleWebSocketClientTestCase(unittest.TestCase):
         client.connected = True
         client.close()
         assert not client.connected
-        mock_socket().send.assert_called_with(
+        mock_socket().sendall.assert_called_with(
             b'CloseConnection(code=<CloseReason.NORMAL_CLOSURE: 1000>, '
-            b'reason=None)')
+            b'reason=None)', 0)
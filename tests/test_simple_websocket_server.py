@@ -1,15 +1,20 @@
+import os
+import re
+import socket
+import threading
 import time
 import unittest
 from unittest import mock
 import pytest  # noqa: F401
 
-from wsproto.events import Request, CloseConnection, TextMessage, \
-    BytesMessage, Ping
+from wsproto import ConnectionState, ConnectionType, WSConnection
+from wsproto.events import AcceptConnection, Request, CloseConnection, \
+    Message, TextMessage, BytesMessage, Ping, Pong
 import simple_websocket
 
 
 class SimpleWebSocketServerTestCase(unittest.TestCase):
-    def get_server(self, mock_wsconn, environ, events=[]):
+    def get_server(self, mock_wsconn, environ, events=[], **kwargs):
         mock_wsconn().events.side_effect = \
             [iter(ev) for ev in [[Request(host='example.com', target='/ws')]] +
              events + [[CloseConnection(1000)]]]
@@ -21,18 +26,28 @@ class SimpleWebSocketServerTestCase(unittest.TestCase):
             'HTTP_SEC_WEBSOCKET_KEY': 'Iv8io/9s+lYFgZWcXczP8Q==',
             'HTTP_SEC_WEBSOCKET_VERSION': '13',
         })
-        return simple_websocket.Server(environ)
+        for key in ['werkzeug.socket', 'gunicorn.socket']:
+            if isinstance(environ.get(key), mock.MagicMock):
+                environ[key].getsockopt.return_value = 65536
+        return simple_websocket.Server(environ, **kwargs)
 
+    @mock.patch('simple_websocket.ws._autotune_limit', lambda name: 0)
     @mock.patch('simple_websocket.ws.WSConnection')
     def test_werkzeug(self, mock_wsconn):
         mock_socket = mock.MagicMock()
-        mock_socket.recv.return_value = b'x'
+        mock_socket.recv_into.return_value = 1
         server = self.get_server(mock_wsconn, {
             'werkzeug.socket': mock_socket,
         })
         assert server.sock == mock_socket
-        assert server.receive_bytes == 4096
-        assert server.input_buffer == []
+        mock_socket.setsockopt.assert_any_call(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        mock_socket.setsockopt.assert_any_call(
+            socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024)
+        assert mock.call(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024) \
+            not in mock_socket.setsockopt.call_args_list
+        assert server.receive_bytes == 65536
+        assert len(server.input_buffer) == 0
         assert server.event.__class__.__name__ == 'Event'
         mock_wsconn().receive_data.assert_any_call(
             b'GET / HTTP/1.1\r\n'
@@ -43,16 +58,19 @@ class SimpleWebSocketServerTestCase(unittest.TestCase):
             b'Sec-Websocket-Version: 13\r\n\r\n')
         assert server.is_server
 
+    @mock.patch('simple_websocket.ws._autotune_limit', lambda name: 1 << 30)
     @mock.patch('simple_websocket.ws.WSConnection')
     def test_gunicorn(self, mock_wsconn):
         mock_socket = mock.MagicMock()
-        mock_socket.recv.return_value = b'x'
+        mock_socket.recv_into.return_value = 1
         server = self.get_server(mock_wsconn, {
             'gunicorn.socket': mock_socket,
         })
         assert server.sock == mock_socket
-        assert server.receive_bytes == 4096
-        assert server.input_buffer == []
+        for args in mock_socket.setsockopt.call_args_list:
+            assert args[0][1] not in [socket.SO_RCVBUF, socket.SO_SNDBUF]
+        assert server.receive_bytes == 65536
+        assert len(server.input_buffer) == 0
         assert server.event.__class__.__name__ == 'Event'
         mock_wsconn().receive_data.assert_any_call(
             b'GET / HTTP/1.1\r\n'
@@ -63,6 +81,17 @@ class SimpleWebSocketServerTestCase(unittest.TestCase):
             b'Sec-Websocket-Version: 13\r\n\r\n')
         assert server.is_server
 
+    @mock.patch('simple_websocket.ws.WSConnection')
+    def test_non_str_header(self, mock_wsconn):
+        mock_socket = mock.MagicMock()
+        mock_socket.recv_into.return_value = 1
+        self.get_server(mock_wsconn, {
+            'werkzeug.socket': mock_socket,
+            'HTTP_X_COUNT': 3,
+        })
+        args = mock_wsconn().receive_data.call_args_list[0][0]
+        assert b'X-Count: 3\r\n' in args[0]
+
     def test_no_socket(self):
         with pytest.raises(RuntimeError):
             self.get_server(mock.MagicMock(), {})
@@ -70,7 +99,7 @@ class SimpleWebSocketServerTestCase(unittest.TestCase):
     @mock.patch('simple_websocket.ws.WSConnection')
     def test_send(self, mock_wsconn):
         mock_socket = mock.MagicMock()
-        mock_socket.recv.return_value = b'x'
+        mock_socket.recv_into.return_value = 1
         server = self.get_server(mock_wsconn, {
             'werkzeug.socket': mock_socket,
         })
@@ -80,18 +109,57 @@ class SimpleWebSocketServerTestCase(unittest.TestCase):
             server.send('hello')
         server.connected = True
         server.send('hello')
-        mock_socket.send.assert_called_with(
+        mock_socket.sendall.assert_called_with(
             b"TextMessage(data='hello', frame_finished=True, "
-            b"message_finished=True)")
+            b"message_finished=True)", 0)
+        server.send(b'hello')
+        mock_socket.sendall.assert_called_with(
+            b"Message(data=b'hello', frame_finished=True, "
+            b"message_finished=True)", 0)
+        server.send(bytearray(b'hello'))
+        mock_socket.sendall.assert_called_with(
+            b"Message(data=bytearray(b'hello'), frame_finished=True, "
+            b"message_finished=True)", 0)
+        server.send(memoryview(b'hello'))
+        mock_socket.sendall.assert_called_with(
+            b"Message(data=b'hello', frame_finished=True, "
+            b"message_finished=True)", 0)
+        with pytest.raises(TypeError):
+            server.send(123)
+
+    @mock.patch('simple_websocket.ws.WSConnection')
+    def test_send_large_binary(self, mock_wsconn):
+        sock, peer = socket.socketpair()
+        server = self.get_server(mock_wsconn, {
+            'werkzeug.socket': sock,
+        })
+        mock_wsconn().state = ConnectionState.OPEN
+        server.send(b'x' * 5000)
+        expected = str(AcceptConnection()).encode() + \
+            b'\x82\x7e\x13\x88' + b'x' * 5000
+        data = b''
+        while len(data) < len(expected):
+            data += peer.recv(65536)
+        assert data == expected
+        server.send(memoryview(bytearray(b'y' * 5000)))
+        expected = b'\x82\x7e\x13\x88' + b'y' * 5000
+        data = b''
+        while len(data) < len(expected):
+            data += peer.recv(65536)
+        assert data == expected
         server.send(b'hello')
-        mock_socket.send.assert_called_with(
+        assert peer.recv(65536) == (
             b"Message(data=b'hello', frame_finished=True, "
             b"message_finished=True)")
+        peer.close()
+        while server.connected:
+            time.sleep(0.01)
+        sock.close()
 
     @mock.patch('simple_websocket.ws.WSConnection')
     def test_receive(self, mock_wsconn):
         mock_socket = mock.MagicMock()
-        mock_socket.recv.return_value = b'x'
+        mock_socket.recv_into.return_value = 1
         server = self.get_server(mock_wsconn, {
             'werkzeug.socket': mock_socket,
         }, events=[
@@ -105,10 +173,40 @@ class SimpleWebSocketServerTestCase(unittest.TestCase):
         assert server.receive() == b'hello'
         assert server.receive(timeout=0) is None
 
+    @mock.patch('simple_websocket.ws.WSConnection')
+    def test_receive_batch(self, mock_wsconn):
+        mock_socket = mock.MagicMock()
+        mock_socket.recv_into.return_value = 1
+        server = self.get_server(mock_wsconn, {
+            'werkzeug.socket': mock_socket,
+        }, events=[
+            [TextMessage('foo'), BytesMessage(b'bar')],
+        ], event_class=mock.MagicMock)
+        while server.connected:
+            time.sleep(0.01)
+        assert list(server.input_buffer) == ['foo', b'bar']
+        assert server.event.set.call_count == 2
+
+    @mock.patch('simple_websocket.ws.WSConnection')
+    def test_receive_partial_frame(self, mock_wsconn):
+        mock_socket = mock.MagicMock()
+        mock_socket.recv_into.return_value = 1
+        server = self.get_server(mock_wsconn, {
+            'werkzeug.socket': mock_socket,
+        }, events=[
+            [],
+            [TextMessage('hello')],
+        ])
+        while server.connected:
+            time.sleep(0.01)
+        server.connected = True
+        assert server.receive() == 'hello'
+        assert server.receive(timeout=0) is None
+
     @mock.patch('simple_websocket.ws.WSConnection')
     def test_receive_split_messages(self, mock_wsconn):
         mock_socket = mock.MagicMock()
-        mock_socket.recv.return_value = b'x'
+        mock_socket.recv_into.return_value = 1
         server = self.get_server(mock_wsconn, {
             'werkzeug.socket': mock_socket,
         }, events=[
@@ -127,7 +225,7 @@ class SimpleWebSocketServerTestCase(unittest.TestCase):
     @mock.patch('simple_websocket.ws.WSConnection')
     def test_receive_ping(self, mock_wsconn):
         mock_socket = mock.MagicMock()
-        mock_socket.recv.return_value = b'x'
+        mock_socket.recv_into.return_value = 1
         server = self.get_server(mock_wsconn, {
             'werkzeug.socket': mock_socket,
         }, events=[
@@ -135,12 +233,41 @@ class SimpleWebSocketServerTestCase(unittest.TestCase):
         ])
         while server.connected:
             time.sleep(0.01)
-        mock_socket.send.assert_any_call(b"Pong(payload=b'hello')")
+        mock_socket.sendall.assert_any_call(b"Pong(payload=b'hello')", 0)
+
+    @mock.patch('simple_websocket.ws.WSConnection')
+    def test_receive_multiple_pings(self, mock_wsconn):
+        mock_socket = mock.MagicMock()
+        mock_socket.recv_into.return_value = 1
+        server = self.get_server(mock_wsconn, {
+            'werkzeug.socket': mock_socket,
+        }, events=[
+            [Ping(b'foo'), Ping(b'bar')],
+        ])
+        while server.connected:
+            time.sleep(0.01)
+        mock_socket.sendall.assert_any_call(
+            b"Pong(payload=b'foo')Pong(payload=b'bar')", 0)
+
+    @mock.patch('simple_websocket.ws.WSConnection')
+    def test_receive_ping_send_error(self, mock_wsconn):
+        mock_socket = mock.MagicMock()
+        mock_socket.recv_into.return_value = 1
+        mock_socket.sendall.side_effect = [None, BrokenPipeError()]
+        server = self.get_server(mock_wsconn, {
+            'werkzeug.socket': mock_socket,
+        }, events=[
+            [Ping(b'hello')],
+        ])
+        server.thread.join(timeout=5)
+        assert not server.thread.is_alive()
+        assert not server.connected
+        assert server.event.is_set()
 
     @mock.patch('simple_websocket.ws.WSConnection')
     def test_receive_empty(self, mock_wsconn):
         mock_socket = mock.MagicMock()
-        mock_socket.recv.side_effect = [b'x', b'x', b'']
+        mock_socket.recv_into.side_effect = [1, 1, 0]
         server = self.get_server(mock_wsconn, {
             'werkzeug.socket': mock_socket,
         }, events=[
@@ -152,10 +279,141 @@ class SimpleWebSocketServerTestCase(unittest.TestCase):
         assert server.receive() == 'hello'
         assert server.receive(timeout=0) is None
 
+    @mock.patch('simple_websocket.ws.WSConnection')
+    def test_receive_drain(self, mock_wsconn):
+        sock, peer = socket.socketpair()
+        peer.sendall(b'abc')
+        server = self.get_server(mock_wsconn, {
+            'werkzeug.socket': sock,
+        }, receive_bytes=1)
+        while server.connected:
+            time.sleep(0.01)
+        mock_wsconn().receive_data.assert_any_call(b'a')
+        mock_wsconn().receive_data.assert_any_call(b'b')
+        mock_wsconn().receive_data.assert_any_call(b'c')
+        assert mock_wsconn().events.call_count == 2
+        sock.close()
+        peer.close()
+
+    def get_real_server(self, sock, peer, **kwargs):
+        client = WSConnection(ConnectionType.CLIENT)
+        request = client.send(Request(host='example.com', target='/ws'))
+        key = re.search(rb'Sec-WebSocket-Key: (\S+)', request).group(1)
+        server = simple_websocket.Server({
+            'werkzeug.socket': sock,
+            'HTTP_HOST': 'example.com',
+            'HTTP_CONNECTION': 'Upgrade',
+            'HTTP_UPGRADE': 'websocket',
+            'HTTP_SEC_WEBSOCKET_KEY': key.decode(),
+            'HTTP_SEC_WEBSOCKET_VERSION': '13',
+        }, **kwargs)
+        client.receive_data(peer.recv(65536))
+        assert isinstance(next(client.events()), AcceptConnection)
+        return server, client
+
+    def test_receive_masked(self):
+        sock, peer = socket.socketpair()
+        server, client = self.get_real_server(sock, peer)
+        assert not hasattr(server, '__dict__')
+
+        # large frames exercise the masking code in wsproto, or its C
+        # replacement when available
+        data = os.urandom(1024 * 1024 + 3)
+        peer.sendall(client.send(Message(data=data)))
+        assert server.receive() == data
+        server.close()
+        peer.close()
+        server.thread.join()
+        sock.close()
+
+    def receive_pongs(self, peer, client, count):
+        pongs = 0
+        peer.settimeout(5)
+        while pongs < count:
+            client.receive_data(peer.recv(65536))
+            pongs += sum(1 for event in client.events()
+                         if isinstance(event, Pong))
+        return pongs
+
+    def test_receive_ping_burst(self):
+        sock, peer = socket.socketpair()
+        server, client = self.get_real_server(sock, peer)
+        peer.sendall(client.send(Ping(b'x')) * 1500)
+        assert self.receive_pongs(peer, client, 1500) == 1500
+        peer.sendall(client.send(Message(data='hello')))
+        assert server.receive(timeout=5) == 'hello'
+        server.close()
+        peer.close()
+        server.thread.join()
+        sock.close()
+
+    def test_reactor(self):
+        reactor = simple_websocket.Reactor()
+        thread = threading.Thread(target=reactor.run)
+        thread.start()
+        sock, peer = socket.socketpair()
+        server, client = self.get_real_server(sock, peer, reactor=reactor)
+        assert server.thread is None
+        peer.sendall(client.send(Message(data='hello')) +
+                     client.send(Message(data=b'bye')))
+        assert server.receive() == 'hello'
+        assert server.receive() == b'bye'
+        peer.sendall(client.send(CloseConnection(1000)))
+        while server.connected:
+            time.sleep(0.01)
+        client.receive_data(peer.recv(65536))
+        assert isinstance(next(client.events()), CloseConnection)
+        assert reactor.selector.get_map().get(sock) is None
+        with pytest.raises(simple_websocket.ConnectionClosed):
+            server.receive()
+        reactor.stop()
+        thread.join()
+        reactor.close()
+        sock.close()
+        peer.close()
+
+    @mock.patch('simple_websocket.ws.traceback.print_exc')
+    def test_reactor_error(self, mock_print_exc):
+        reactor = simple_websocket.Reactor()
+        thread = threading.Thread(target=reactor.run)
+        thread.start()
+        sock1, peer1 = socket.socketpair()
+        server1, client1 = self.get_real_server(sock1, peer1, reactor=reactor)
+        sock2, peer2 = socket.socketpair()
+        server2, client2 = self.get_real_server(sock2, peer2, reactor=reactor)
+        with mock.patch.object(server1, 'ws') as mock_ws:
+            mock_ws.receive_data.side_effect = RuntimeError()
+            peer1.sendall(client1.send(Message(data='hello')))
+            with pytest.raises(simple_websocket.ConnectionClosed):
+                server1.receive(timeout=5)
+        assert not server1.connected
+        assert reactor.selector.get_map().get(sock1) is None
+        while not mock_print_exc.called:  # pragma: no cover
+            time.sleep(0.01)
+        mock_print_exc.assert_called_once_with()
+
+        peer2.sendall(client2.send(Message(data='hello')))
+        assert server2.receive(timeout=5) == 'hello'
+        server2.close()
+        reactor.stop()
+        thread.join()
+        reactor.close()
+        for s in [sock1, peer1, sock2, peer2]:
+            s.close()
+
+    def test_reactor_stop_before_run(self):
+        reactor = simple_websocket.Reactor()
+        reactor.stop()
+        thread = threading.Thread(target=reactor.run)
+        thread.start()
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+        reactor.close()
+
     @mock.patch('simple_websocket.ws.WSConnection')
     def test_close(self, mock_wsconn):
         mock_socket = mock.MagicMock()
-        mock_socket.recv.return_value = b'x'
+        mock_socket.recv_into.return_value = 1
         server = self.get_server(mock_wsconn, {
             'werkzeug.socket': mock_socket,
         })
@@ -166,6 +424,20 @@ class SimpleWebSocketServerTestCase(unittest.TestCase):
         server.connected = True
         server.close()
         assert not server.connected
-        mock_socket.send.assert_called_with(
+        mock_socket.sendall.assert_called_with(
             b'CloseConnection(code=<CloseReason.NORMAL_CLOSURE: 1000>, '
-            b'reason=None)')
+            b'reason=None)', 0)
+
+    @mock.patch('simple_websocket.ws.WSConnection')
+    def test_close_broken(self, mock_wsconn):
+        sock, peer = socket.socketpair()
+        server = self.get_server(mock_wsconn, {
+            'werkzeug.socket': sock,
+        })
+        peer.close()
+        while server.connected:
+            time.sleep(0.01)
+        server.connected = True
+        server.close()
+        assert not server.connected
+        sock.close()